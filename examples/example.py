@@ -1,7 +1,8 @@
 from imageio import imread
-from pycodecs import X265, AV1, BPG, Codec, X264, JPEG, JPEG2000, MJPEG
+from pycodecs import X265, AV1, BPG, Codec, X264, JPEG, JPEG2000, MJPEG, apply_many
 import numpy as np
 from time import time
+from typing import List, Tuple
 import argparse
 
 
@@ -16,6 +17,12 @@ def rgb2ycbcr(rgb_image: np.ndarray) -> np.ndarray:
     return np.clip(np.matmul(rgb_image.astype(np.float32), weights.T) + bias, 16, 255).astype(np.uint8)
 
 
+def psnr(restored: np.ndarray, source: np.ndarray) -> float:
+    se = np.square(rgb2ycbcr(restored).astype(np.float32) - rgb2ycbcr(source).astype(np.float32))
+    mse = np.sum(np.mean(se, axis=(0, 1)) * np.array([6.0, 1.0, 1.0]) / 8.0)
+    return 10.0 * np.log10(255.0 * 255.0 / mse)
+
+
 def encode(codec: Codec, image: str, show_syscalls: bool = False):
 
     if not codec.available():
@@ -26,11 +33,8 @@ def encode(codec: Codec, image: str, show_syscalls: bool = False):
     t0 = time()
     encoded_len, restored = codec.apply(original=source)
     dT = time() - t0
-    se = np.square(rgb2ycbcr(restored).astype(np.float32) - rgb2ycbcr(source).astype(np.float32))
-    mse = np.sum(np.mean(se, axis=(0, 1)) * np.array([6.0, 1.0, 1.0]) / 8.0)
-    psnr = 10.0 * np.log10(255.0 * 255.0 / mse)
     print(
-        f"{codec.__class__.__name__}: Encoded image has YCbCr444 PSNR={psnr:0.4f}dB at "
+        f"{codec.__class__.__name__}: Encoded image has YCbCr444 PSNR={psnr(restored, source):0.4f}dB at "
         f"{encoded_len * 8 / source.size * 3:0.4f}bpp. "
         f"Took {dT:0.4f}s")
     if show_syscalls and len(codec.system_calls) >= 2:
@@ -40,12 +44,28 @@ def encode(codec: Codec, image: str, show_syscalls: bool = False):
               f"RSP: {codec.system_calls[-2][1]}")
 
 
+def compare(codecs: List[Tuple[Codec, int]], image: str, max_workers: int = 1):
+    codecs = [(codec, quality) for codec, quality in codecs if codec.available()]
+    source = np.array(imread(image))
+    t0 = time()
+    results = apply_many(original=source, codecs=codecs, max_workers=max_workers)
+    dT = time() - t0
+    print(f"Compared {len(results)} codec settings using {max_workers} worker(s) in {dT:0.4f}s:")
+    for result in results:
+        assert result.restored.shape == source.shape
+        print(f"{result.codec.__class__.__name__:>10} q={result.quality:<3}: "
+              f"PSNR={psnr(result.restored, source):0.4f}dB at "
+              f"{result.encoded_size_bytes * 8 / source.size * 3:0.4f}bpp. "
+              f"Encoding took {result.encode_seconds:0.4f}s, decoding {result.decode_seconds:0.4f}s")
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--ffmpeg_backend", type=str, choices=['ffmpeg', 'pyav'], default='ffmpeg')
     parser.add_argument("--ffmpeg_path", type=str, default=None)
     parser.add_argument("--image", type=str, default="examples/Kinkaku-ji.png")
+    parser.add_argument("--max_workers", type=int, default=1)
     args = parser.parse_args()
     encode(codec=JPEG(quality=33, optimize=True), image=args.image)
     encode(codec=MJPEG(quality=13, backend=args.ffmpeg_backend), image=args.image)
@@ -57,5 +77,7 @@ if __name__ == "__main__":
            image=args.image)
     encode(codec=AV1(ffmpeg_path=args.ffmpeg_path, backend=args.ffmpeg_backend, pixel_format='yuv444p', quality=42),
            image=args.image)
-
-
+    jpeg = JPEG(optimize=True)
+    x264 = X264(ffmpeg_path=args.ffmpeg_path, backend=args.ffmpeg_backend, pixel_format='yuv444p')
+    compare(codecs=[(jpeg, 25), (jpeg, 50), (jpeg, 75), (x264, 27), (x264, 37), (BPG(format='444'), 36)],
+            image=args.image, max_workers=args.max_workers)
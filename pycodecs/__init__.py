@@ -1 +1,2 @@
-from .pycodecs import Codec, BPG, WebP, X265, H265, AV1, X264, JPEG, JPEG2000, MJPEG
+from .pycodecs import Codec, BPG, WebP, X265, H265, AV1, X264, JPEG, JPEG2000, MJPEG, CodecResult, \
+    apply_many
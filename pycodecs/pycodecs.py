@@ -3,11 +3,14 @@ from tempfile import NamedTemporaryFile
 import imageio
 import os
 import subprocess
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Tuple, NamedTuple
 from distutils.spawn import find_executable
 import re
 from .util import RoundRobinList
 from io import BytesIO
+from time import perf_counter
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import av
@@ -33,6 +36,15 @@ class Codec(object):
     def decode(self, source: Union[str, bytes], target: Union[str, None] = None) -> Union[None, np.ndarray]:
         raise NotImplementedError()
 
+    def _encode_limited(self, source: Union[str, np.ndarray], target: Union[str, None], quality: int,
+                        threads: Union[int, None]) -> Union[None, bytes]:
+        # Codecs that can limit their number of threads override this, the others ignore the limit
+        return self.encode(source, target, quality)
+
+    def _decode_limited(self, source: Union[str, bytes], target: Union[str, None], threads: Union[int, None]) \
+            -> Union[None, np.ndarray]:
+        return self.decode(source, target)
+
     def can_pipe(self) -> bool:
         raise NotImplementedError()
 
@@ -44,25 +56,21 @@ class Codec(object):
 
     def apply(self, original: Union[np.ndarray, str], quality: int = None, encoded: str = None, decoded: str = None) -> \
             (int, np.ndarray):
-        channels_first = False
+        prepared = PreparedOriginal(original)
+        try:
+            encoded_size_bytes, restored, _, _ = self._apply_prepared(prepared, quality, encoded, decoded)
+        finally:
+            prepared.close()
+        return encoded_size_bytes, restored
+
+    def _apply_prepared(self, prepared: 'PreparedOriginal', quality: int = None, encoded: str = None,
+                        decoded: str = None, threads: int = None) -> (int, np.ndarray, float, float):
         encode_to_file = encoded is not None
         decode_to_file = decoded is not None
-        original_file = None
-        if type(original) == np.ndarray:
-            original_ndim = original.ndim
-            if original.ndim == 4:
-                if original.shape[0] != 1:
-                    raise ValueError("If a 4D ndarray is supplied, it can only have a single entry in the first "
-                                     "dimension")
-                original = original[0]
-            if original.ndim == 3:  # Check which is the channel dimension
-                if original.shape[0] == 3 and not original.shape[2] == 3:
-                    original = np.transpose(original, (1, 2, 0))
-                    channels_first = True
-            if not self.can_pipe():
-                original_file = NamedTemporaryFile(suffix=".png")
-                imageio.imwrite(original_file.name, original)
-                original = original_file.name
+        if self.can_pipe():
+            original = prepared.image
+        else:
+            original = prepared.file_name()
 
         encoded_file = None
         if encoded is None and not self.can_pipe():
@@ -77,14 +85,19 @@ class Codec(object):
         if quality is None:
             quality = self.default_quality
 
-        encoder_output = self.encode(original, encoded, quality)
+        # Wall-clock times, i.e. they include any contention with concurrently running codecs
+        t0 = perf_counter()
+        encoder_output = self._encode_limited(original, encoded, quality, threads)
+        encode_seconds = perf_counter() - t0
         if not encode_to_file and self.can_pipe():
             encoded = encoder_output
             encoded_size_bytes = len(encoded)
         else:
             encoded_size_bytes = os.stat(encoded).st_size
 
-        decoder_output = self.decode(encoded, decoded)
+        t0 = perf_counter()
+        decoder_output = self._decode_limited(encoded, decoded, threads)
+        decode_seconds = perf_counter() - t0
 
         if not decode_to_file:
             if self.can_pipe():
@@ -95,21 +108,136 @@ class Codec(object):
             restored = None
 
         if restored is not None:
-            if channels_first:
-                restored = np.transpose(restored, (2, 0, 1))
-            if type(original) == np.ndarray:
-                while restored.ndim < original_ndim:
-                    restored = restored[None]
+            restored = prepared.restore_layout(restored)
 
         if decoded_file is not None:
             decoded_file.close()
 
         if encoded_file is not None:
             encoded_file.close()
+        return encoded_size_bytes, restored, encode_seconds, decode_seconds
 
-        if original_file is not None:
-            original_file.close()
-        return encoded_size_bytes, restored
+
+class PreparedOriginal(object):
+    """Original image in the layout the codecs expect, prepared once so it can be shared by several codecs.
+
+    Holds a contiguous ``HxWxC`` array and a PNG file of it for codecs that cannot pipe, which is written on
+    first use. Call ``close`` (or use it as context manager) to remove it. If a path is given, it is passed on
+    as is, unless ``load`` is called to read it into an (8 bit RGB) array shared by the codecs that can pipe.
+    """
+
+    def __init__(self, original: Union[np.ndarray, str]):
+        self.channels_first = False
+        self.original_ndim = None
+        self._path = None
+        self._file = None
+        self._lock = Lock()
+        if type(original) == np.ndarray:
+            self.original_ndim = original.ndim
+            if original.ndim == 4:
+                if original.shape[0] != 1:
+                    raise ValueError("If a 4D ndarray is supplied, it can only have a single entry in the first "
+                                     "dimension")
+                original = original[0]
+            if original.ndim == 3:  # Check which is the channel dimension
+                if original.shape[0] == 3 and not original.shape[2] == 3:
+                    original = np.transpose(original, (1, 2, 0))
+                    self.channels_first = True
+            original = np.ascontiguousarray(original)
+        else:
+            self._path = original
+        self.image = original
+
+    def load(self):
+        if type(self.image) == str:
+            self.image = np.ascontiguousarray(imageio.imread(self.image, pilmode='RGB'))
+
+    def file_name(self) -> str:
+        if self._path is not None:
+            return self._path
+        with self._lock:
+            if self._file is None:
+                self._file = NamedTemporaryFile(suffix=".png")
+                imageio.imwrite(self._file.name, self.image)
+        return self._file.name
+
+    def restore_layout(self, restored: np.ndarray) -> np.ndarray:
+        if self.channels_first:
+            restored = np.transpose(restored, (2, 0, 1))
+        if self.original_ndim is not None:
+            while restored.ndim < self.original_ndim:
+                restored = restored[None]
+        return restored
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CodecResult(NamedTuple):
+    codec: Codec
+    quality: int
+    encoded_size_bytes: int
+    restored: np.ndarray
+    encode_seconds: float
+    decode_seconds: float
+
+
+def apply_many(original: Union[np.ndarray, str], codecs: List[Union[Codec, Tuple[Codec, int]]],
+               max_workers: int = 1, cores: int = None) -> List[CodecResult]:
+    """Apply several codecs to the same original, preparing the input only once.
+
+    The core budget is split evenly among the concurrently running codecs and passed on as thread limit to the
+    ffmpeg-based codecs (``-threads`` for the ffmpeg backend, ``thread_count`` for PyAV and additionally
+    ``pools`` in the ``x265-params`` for X265). BPG, WebP and JPEG are not limited. Timings are wall-clock, so with
+    ``max_workers > 1`` they include contention with the other codecs; keep ``max_workers=1`` for timing comparisons.
+
+    If ``original`` is a path and more than one codec that can pipe (or one using the PyAV backend) is given, the
+    file is read once into an 8 bit RGB array which is shared by them. Otherwise, the path is passed on as is.
+
+    :param original: path to image file or ``numpy.ndarray`` as accepted by ``Codec.apply``
+    :param codecs: codecs to apply, either a ``Codec`` (its default quality is used) or a ``(codec, quality)`` tuple.
+        The same instance may appear several times (e.g. at different qualities).
+    :param max_workers: number of codecs run concurrently
+    :param cores: number of cores to use in total, defaults to the number of cores this process may run on
+    :return: one ``CodecResult`` per entry of ``codecs``, in the same order
+    """
+    jobs = list()
+    for entry in codecs:
+        if isinstance(entry, Codec):
+            codec, quality = entry, entry.default_quality
+        else:
+            codec, quality = entry
+            if quality is None:
+                quality = codec.default_quality
+        jobs.append((codec, quality))
+    if cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            cores = len(os.sched_getaffinity(0))
+        else:
+            cores = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, cores, len(jobs)))
+    threads = max(1, cores // max_workers)
+
+    def run(job: Tuple[Codec, int]) -> CodecResult:
+        codec, quality = job
+        return CodecResult(codec, quality, *codec._apply_prepared(prepared, quality, threads=threads))
+
+    with PreparedOriginal(original) as prepared:
+        pipe_codecs = [codec for codec, _ in jobs if codec.can_pipe()]
+        if len(pipe_codecs) > 1 or any(isinstance(codec, FFMPEG) and codec.backend == 'pyav' for codec in pipe_codecs):
+            prepared.load()
+        if max_workers == 1:
+            return [run(job) for job in jobs]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, jobs))
 
 
 class BPG(Codec):
@@ -202,6 +330,19 @@ def _param_to_arg_list(param: Dict[str, str]) -> List[str]:
     return result
 
 
+def _merge_params(*params: Dict[str, str]) -> Dict[str, str]:
+    result = dict()
+    for param in params:
+        for k, v in param.items():
+            if v is None:
+                continue
+            if k in result.keys():
+                result[k] = result[k] + ":" + v
+            else:
+                result[k] = v
+    return result
+
+
 class FFMPEG(Codec):
 
     def __init__(self, pixel_format: str = 'yuv444p', ffmpeg_path: str = None, backend: str = None, format: str = 'nut',
@@ -237,6 +378,10 @@ class FFMPEG(Codec):
     def _quality_param(self, quality: int) -> Dict[str, str]:
         raise NotImplementedError()
 
+    def _thread_param(self, threads: int) -> Dict[str, str]:
+        # Encoder specific options for encoders which don't follow ffmpeg's generic thread count
+        return dict()
+
     def _is_ffmpeg_backend_available(self) -> bool:
         ffmpeg_exec = find_executable(self.ffmpeg_path)
         if ffmpeg_exec is None:
@@ -256,18 +401,10 @@ class FFMPEG(Codec):
                     return True
         return False
 
-    def _encode_pyav(self, source: np.ndarray, quality: int) -> bytes:
+    def _encode_pyav(self, source: np.ndarray, quality: int, threads: int = None) -> bytes:
         assert type(source) == np.ndarray, f"Source must be numpy.ndarray for PyAV but was {type(source)}"
-        options_dict = dict()
-        for k, v in self.additional_output_commands.items():
-            if v is None:
-                continue
-            options_dict[k] = v
-        for k, v in self._quality_param(quality).items():
-            if k in options_dict.keys():
-                options_dict[k] = options_dict[k] + ":" + v
-            else:
-                options_dict[k] = v
+        thread_param = self._thread_param(threads) if threads is not None else dict()
+        options_dict = _merge_params(self.additional_output_commands, self._quality_param(quality), thread_param)
         bio = BytesIO()
         container = av.open(bio, mode='w', format=self.format)
 
@@ -277,6 +414,8 @@ class FFMPEG(Codec):
         stream.pix_fmt = self.pixel_format
         stream.codec_context.bit_rate = 0  # Needs to be set to 0 for libaom-av1 to work properly
         stream.codec_context.bit_rate_tolerance = 0
+        if threads is not None:
+            stream.codec_context.thread_count = threads
         # Mux the packets of the stream into the container
         frame = av.VideoFrame.from_ndarray(source, format='rgb24')
         for packet in stream.encode(frame):
@@ -287,14 +426,16 @@ class FFMPEG(Codec):
         container.close()
         return bio.getvalue()
 
-    def _decode_pyav(self, source: bytes) -> np.ndarray:
+    def _decode_pyav(self, source: bytes, threads: int = None) -> np.ndarray:
         bio = BytesIO(source)
         container = av.open(bio, mode='r', format=self.format)
+        if threads is not None:
+            container.streams.video[0].codec_context.thread_count = threads
         for frame in container.decode(video=0):
             return frame.to_ndarray(format='rgb24')
 
-    def _encode_ffmpeg(self, source: Union[str, np.ndarray], target: Union[str, None] = None, quality: int = None) \
-            -> Union[None, bytes]:
+    def _encode_ffmpeg(self, source: Union[str, np.ndarray], target: Union[str, None] = None, quality: int = None,
+                       threads: int = None) -> Union[None, bytes]:
         input_cmd = list()
         if type(source) == str:
             source_file = source
@@ -309,16 +450,22 @@ class FFMPEG(Codec):
         target_pixel_format = []
         if self.pixel_format is not None:
             target_pixel_format = ["-pix_fmt", self.pixel_format]
+        thread_cmd = []
+        thread_param = dict()
+        if threads is not None:
+            thread_cmd = ["-threads", str(threads)]
+            thread_param = self._thread_param(threads)
         # , '-loglevel', 'panic', '-nostats'
         cmd = [self.ffmpeg_path, '-y', '-hide_banner'] + \
             _param_to_arg_list(self.additional_input_commands) + input_cmd + \
-              ["-i", source_file, "-c:v", self.codec] + target_pixel_format \
-            + _param_to_arg_list(self._quality_param(quality)) \
+              ["-i", source_file, "-c:v", self.codec] + target_pixel_format + thread_cmd \
+            + _param_to_arg_list(_merge_params(self._quality_param(quality), thread_param)) \
             + _param_to_arg_list(self.additional_output_commands) +\
               ['-f', self.format, target_file]
         proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if type(source) == np.ndarray:
-            stream, message = proc.communicate(input=source.tobytes())  # if target is a file, then stream will be None
+            # Hand over the (contiguous) buffer without copying it; if target is a file, then stream will be None
+            stream, message = proc.communicate(input=memoryview(np.ascontiguousarray(source)).cast('B'))
         else:
             stream, message = proc.communicate()
         self.system_calls.append((cmd, message.decode()))
@@ -326,19 +473,24 @@ class FFMPEG(Codec):
 
     def encode(self, source: Union[str, np.ndarray], target: Union[str, None] = None, quality: int = None) \
             -> Union[None, bytes]:
+        return self._encode_limited(source, target, quality, None)
+
+    def _encode_limited(self, source: Union[str, np.ndarray], target: Union[str, None], quality: int,
+                        threads: Union[int, None]) -> Union[None, bytes]:
         if quality is None:
             quality = self.default_quality
         if quality not in self.quality_steps():
             raise ValueError("Given quality index is not a valid quality step!")
 
         if self.backend == 'ffmpeg':
-            return self._encode_ffmpeg(source, target, quality)
+            return self._encode_ffmpeg(source, target, quality, threads)
         elif self.backend == 'pyav':
             if type(source) == str:
                 raise ValueError("PyAV backend for now only supports numpy.ndarray")
-            return self._encode_pyav(source, quality)
+            return self._encode_pyav(source, quality, threads)
 
-    def _decode_ffmpeg(self, source: Union[str, bytes], target: Union[str, None] = None) -> Union[None, np.ndarray]:
+    def _decode_ffmpeg(self, source: Union[str, bytes], target: Union[str, None] = None, threads: int = None) \
+            -> Union[None, np.ndarray]:
         source_file = source
         if type(source) == bytes:
             source_file = "-"
@@ -348,8 +500,11 @@ class FFMPEG(Codec):
             target_file = "-"
             output_spec = ['-pix_fmt', 'rgb24', '-f', 'rawvideo']
 
-        cmd = [self.ffmpeg_path, '-y', '-hide_banner', '-f', self.format, '-i', source_file] + output_spec + [
-            target_file]
+        thread_cmd = list()
+        if threads is not None:
+            thread_cmd = ['-threads', str(threads)]
+        cmd = [self.ffmpeg_path, '-y', '-hide_banner'] + thread_cmd + ['-f', self.format, '-i', source_file] + \
+            output_spec + [target_file]
         proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
         if type(source) == bytes:
@@ -357,10 +512,11 @@ class FFMPEG(Codec):
         else:
             comm = proc.communicate()
 
-        self.system_calls.append((cmd, comm[1].decode()))
+        message = comm[1].decode()
+        self.system_calls.append((cmd, message))
         if target is None:
             h = w = 0
-            for line in comm[1].decode().split('\n'):
+            for line in message.split('\n'):
                 if line.strip().startswith("Stream"):
                     for d in line.strip().split(','):
                         match = re.search("^([0-9]{1,4})x([0-9]{1,4}){0,1}.*", d.strip())
@@ -369,20 +525,21 @@ class FFMPEG(Codec):
                             h = int(match.groups()[1])
             if h == 0 or w == 0:
                 raise ValueError(f"Could not find image dimensions in FFMPEG info.\n"
-                                 f"Last two commands/responses:\n"
-                                 f"CMD: {self.system_calls[-1][0]}\n"
-                                 f"RSP: {self.system_calls[-1][1]}\n"
-                                 f"CMD: {self.system_calls[-2][0]}\n"
-                                 f"RSP: {self.system_calls[-2][1]}")
+                                 f"CMD: {cmd}\n"
+                                 f"RSP: {message}")
             return np.frombuffer(comm[0], dtype=np.uint8).reshape(h, w, 3)
         else:
             return None
 
     def decode(self, source: Union[str, bytes], target: Union[str, None] = None) -> Union[None, np.ndarray]:
+        return self._decode_limited(source, target, None)
+
+    def _decode_limited(self, source: Union[str, bytes], target: Union[str, None], threads: Union[int, None]) \
+            -> Union[None, np.ndarray]:
         if self.backend == 'ffmpeg':
-            return self._decode_ffmpeg(source, target)
+            return self._decode_ffmpeg(source, target, threads)
         elif self.backend == 'pyav':
-            return self._decode_pyav(source)
+            return self._decode_pyav(source, threads)
 
 
 class AV1(FFMPEG):
@@ -424,6 +581,10 @@ class X265(FFMPEG):
     def _quality_param(self, quality: int) -> Dict[str, str]:
         return {"x265-params": f"qp={quality}"}
 
+    def _thread_param(self, threads: int) -> Dict[str, str]:
+        # libx265 in ffmpeg doesn't forward the thread count, it has to be passed as size of x265's thread pool
+        return {"x265-params": f"pools={threads}"}
+
     def quality_steps(self):
         return [q for q in range(51, -1, -1)]
 
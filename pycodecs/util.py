@@ -1,5 +1,6 @@
 from collections import Iterable
 from math import copysign
+from threading import Lock
 
 
 class RoundRobinList(Iterable):
@@ -8,6 +9,7 @@ class RoundRobinList(Iterable):
         self._entries = list()
         self._next_write = 0
         self._max_size = max_size
+        self._lock = Lock()
 
     def __iter__(self):
         return self
@@ -19,11 +21,12 @@ class RoundRobinList(Iterable):
         return len(self._entries)
 
     def append(self, item):
-        if len(self._entries) < self.max_size:
-            self._entries.append(item)
-        else:
-            self._entries[self._next_write] = item
-            self._next_write = (self.next_write + 1) % self.max_size
+        with self._lock:
+            if len(self._entries) < self.max_size:
+                self._entries.append(item)
+            else:
+                self._entries[self._next_write] = item
+                self._next_write = (self.next_write + 1) % self.max_size
 
     @property
     def next_write(self):